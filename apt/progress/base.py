@@ -3,17 +3,46 @@ from __future__ import print_function
 import errno
 import fcntl
 import io
+import logging
 import os
 import re
-import select
+import selectors
 import sys
 
-from typing import Optional, Union
+from typing import Optional, Tuple, Union
 
 import apt_pkg
 
 __all__ = ['AcquireProgress', 'CdromProgress', 'InstallProgress', 'OpProgress']
 
+# Matches the "'current' 'new'" part of a conffile prompt. The quoted parts
+# use [^']* instead of .* so that long status lines cannot cause quadratic
+# backtracking. Prompts are parsed by _parse_conffile(), this pattern is only
+# used to cross-check it when assertions are enabled.
+_CONFFILE_RE = re.compile(r"\s*'([^']*)'\s*'([^']*)'")
+
+# Errors signalling that the non-blocking status fd has been drained
+_TRANSIENT_ERRNOS = frozenset((errno.EAGAIN, errno.EWOULDBLOCK))
+
+
+def _parse_conffile(status_str):
+    # type: (str) -> Optional[Tuple[str, str]]
+    """Return the (current, new) file names of a conffile prompt.
+
+    The names are the first two single-quoted strings in 'status_str',
+    None is returned if there are not enough quotes.
+    """
+    start_cur = status_str.find("'")
+    end_cur = status_str.find("'", start_cur + 1)
+    if start_cur < 0 or end_cur < 0:
+        return None
+    start_new = status_str.find("'", end_cur + 1)
+    end_new = status_str.find("'", start_new + 1)
+    if start_new < 0 or end_new < 0:
+        return None
+    return (status_str[start_cur + 1:end_cur],
+            status_str[start_new + 1:end_new])
+
 
 class AcquireProgress(object):
     """Monitor object for downloads controlled by the Acquire class.
@@ -138,7 +167,23 @@ class InstallProgress(object):
         # These will leak fds, but fixing this safely requires API changes.
         self.write_stream = os.fdopen(self.writefd, "w")  # type: io.TextIOBase
         self.status_stream = os.fdopen(self.statusfd, "r")  # type: io.TextIOBase # noqa
+        # os.pipe() already creates both ends atomically with O_CLOEXEC. Do
+        # not use os.pipe2(os.O_NONBLOCK) here: it would also make the write
+        # end non-blocking and dpkg would get EAGAIN once the pipe is full.
         fcntl.fcntl(self.statusfd, fcntl.F_SETFL, os.O_NONBLOCK)
+        # Bytes read from statusfd which do not form a complete line yet
+        self._buf = bytearray()
+        # Scratch buffer that statusfd is read into, reused for every read
+        self._readbuf = memoryview(bytearray(65536))
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self.statusfd, selectors.EVENT_READ)
+        self._handlers = {
+            'pmerror': self._on_error,
+            'error': self._on_error,
+            'conffile-prompt': self._on_conffile,
+            'pmconffile': self._on_conffile,
+            'pmstatus': self._on_pmstatus,
+        }
 
     def start_update(self):
         # type: () -> None
@@ -154,6 +199,7 @@ class InstallProgress(object):
 
     def __exit__(self, type, value, traceback):
         # type: (object, object, object) -> None
+        self._selector.close()
         self.write_stream.close()
         self.status_stream.close()
 
@@ -231,50 +277,90 @@ class InstallProgress(object):
     def update_interface(self):
         # type: () -> None
         """Update the interface."""
-        try:
-            line = self.status_stream.readline()
-        except IOError as err:
-            # resource temporarly unavailable is ignored
-            if err.errno != errno.EAGAIN and err.errno != errno.EWOULDBLOCK:
-                print(err.strerror)
+        # Drain everything dpkg has written so far and process it in one go
+        while True:
+            try:
+                count = os.readv(self.statusfd, [self._readbuf])
+            except OSError as err:
+                # resource temporarly unavailable is ignored
+                if err.errno not in _TRANSIENT_ERRNOS:
+                    logging.warning("%s", err.strerror)
+                break
+            if not count:
+                break
+            self._buf += self._readbuf[:count]
+
+        end = self._buf.rfind(b"\n")
+        if end < 0:
             return
-
+        lines = self._buf[:end].splitlines()
+        del self._buf[:end + 1]
+        for line in lines:
+            self._process_line(line.decode("utf-8", "replace"))
+
+    def _process_line(self, line):
+        # type: (str) -> None
+        """Parse a single line of the status fd and dispatch it."""
         pkgname = status = status_str = percent = base = ""
 
-        if line.startswith('pm'):
-            try:
-                (status, pkgname, percent, status_str) = line.split(":", 3)
-            except ValueError:
+        kind, _sep, rest = line.partition(":")
+        colons = line.count(":")
+        if kind.startswith('pm'):
+            # pmstatus:pkg:percent:message
+            if colons < 3:
                 # silently ignore lines that can't be parsed
                 return
-        elif line.startswith('status'):
-            try:
-                (base, pkgname, status, status_str) = line.split(":", 3)
-            except ValueError:
-                (base, pkgname, status) = line.split(":", 2)
-        elif line.startswith('processing'):
-            (status, status_str, pkgname) = line.split(":", 2)
+            status = kind
+            (pkgname, _sep, rest) = rest.partition(":")
+            (percent, _sep, status_str) = rest.partition(":")
+        elif kind.startswith('status'):
+            # status: pkg: status[: message]
+            if colons < 2:
+                return
+            base = kind
+            (pkgname, _sep, rest) = rest.partition(":")
+            (status, _sep, status_str) = rest.partition(":")
+        elif kind.startswith('processing'):
+            # processing: stage: pkg
+            if colons < 2:
+                return
+            status = kind
+            (status_str, _sep, pkgname) = rest.partition(":")
             self.processing(pkgname.strip(), status_str.strip())
 
-        # Always strip the status message
-        pkgname = pkgname.strip()
-        status_str = status_str.strip()
         status = status.strip()
 
-        if status == 'pmerror' or status == 'error':
-            self.error(pkgname, status_str)
-        elif status == 'conffile-prompt' or status == 'pmconffile':
-            match = re.match("\\s*\'(.*)\'\\s*\'(.*)\'.*", status_str)
-            if match:
-                self.conffile(match.group(1), match.group(2))
-        elif status == "pmstatus":
-            # FIXME: Float comparison
-            if float(percent) != self.percent or status_str != self.status:
-                self.status_change(pkgname, float(percent), status_str.strip())
-                self.percent = float(percent)
-                self.status = status_str.strip()
+        handler = self._handlers.get(status)
+        if handler is not None:
+            handler(pkgname, status_str, percent)
         elif base == "status":
-            self.dpkg_status_change(pkgname, status)
+            self.dpkg_status_change(pkgname.strip(), status)
+
+    def _on_error(self, pkgname, status_str, percent):
+        # type: (str, str, str) -> None
+        """Handle an error reported by dpkg or APT."""
+        self.error(pkgname.strip(), status_str.strip())
+
+    def _on_conffile(self, pkgname, status_str, percent):
+        # type: (str, str, str) -> None
+        """Handle a conffile prompt."""
+        files = _parse_conffile(status_str)
+        if __debug__:
+            match = _CONFFILE_RE.match(status_str)
+            assert match is None or match.groups() == files
+        if files is not None:
+            self.conffile(*files)
+
+    def _on_pmstatus(self, pkgname, status_str, percent):
+        # type: (str, str, str) -> None
+        """Handle a change of the APT status."""
+        pct = float(percent)
+        status_str = status_str.strip()
+        # FIXME: Float comparison
+        if pct != self.percent or status_str != self.status:
+            self.status_change(pkgname.strip(), pct, status_str)
+            self.percent = pct
+            self.status = status_str
 
     def wait_child(self):
         # type: () -> int
@@ -285,25 +371,41 @@ class InstallProgress(object):
         full status returned from os.waitpid() (not only the return code).
         """
         (pid, res) = (0, 0)
-        while True:
-            try:
-                select.select([self.status_stream], [], [],
-                              self.select_timeout)
-            except select.error as error:
-                (errno_, _errstr) = error.args
-                if errno_ != errno.EINTR:
-                    raise
-
-            self.update_interface()
-            try:
-                (pid, res) = os.waitpid(self.child_pid, os.WNOHANG)
-                if pid == self.child_pid:
-                    break
-            except OSError as err:
-                if err.errno == errno.ECHILD:
-                    break
-                if err.errno != errno.EINTR:
-                    raise
+        pidfd = None  # type: Optional[int]
+        try:
+            # A pidfd becomes readable once the child exits (Linux >= 5.3),
+            # so we only need to call waitpid() once it has been signalled.
+            fd = os.pidfd_open(self.child_pid)
+        except (AttributeError, OSError):
+            pass
+        else:
+            self._selector.register(fd, selectors.EVENT_READ, "pid")
+            pidfd = fd
+
+        try:
+            while True:
+                try:
+                    events = self._selector.select(self.select_timeout)
+                except InterruptedError:
+                    events = []
+
+                self.update_interface()
+                if pidfd is not None and not any(key.data == "pid"
+                                                 for key, _mask in events):
+                    continue
+                try:
+                    (pid, res) = os.waitpid(self.child_pid, os.WNOHANG)
+                    if pid == self.child_pid:
+                        break
+                except OSError as err:
+                    if err.errno == errno.ECHILD:
+                        break
+                    if err.errno != errno.EINTR:
+                        raise
+        finally:
+            if pidfd is not None:
+                self._selector.unregister(pidfd)
+                os.close(pidfd)
 
         return res
 
@@ -1,12 +1,18 @@
 from __future__ import print_function
 
+import bisect
+import fcntl
 import io
+import itertools
 import os
 import signal
+import struct
 import sys
+import termios
+import time
 
 import types
-from typing import Callable, Optional, Union
+from typing import Callable, List, Optional, Tuple, Union
 
 
 import apt_pkg
@@ -15,6 +21,10 @@ from apt.progress import base
 
 __all__ = ['AcquireProgress', 'CdromProgress', 'OpProgress']
 
+# Argument and result decoder for the TIOCGWINSZ ioctl (struct winsize)
+_WINSZ_BUF = 8 * b' '
+_WINSZ_UNPACK = struct.Struct('hhhh').unpack
+
 
 def _(msg):
     # type: (str) -> str
@@ -25,6 +35,33 @@ def _(msg):
     return res
 
 
+def _snapshot_workers(owner):
+    # type: (apt_pkg.Acquire) -> List[Tuple[Optional[int], str, str, int, int, bool]] # noqa
+    """Collect the state of all workers of 'owner' in a single pass.
+
+    Return a list of (id, description, active subprocess, current size,
+    total size, complete) tuples, so that pulse() can format the status
+    line without going back to the apt_pkg objects. For idle workers the
+    id is None and the description is the worker status; idle workers
+    without a status are left out.
+    """
+    snapshot = []  # type: List[Tuple[Optional[int], str, str, int, int, bool]] # noqa
+    for worker in owner.workers:
+        item = worker.current_item
+        if not item:
+            if worker.status:
+                snapshot.append((None, worker.status, "", 0, 0, False))
+            continue
+        item_owner = item.owner
+        item_id = item_owner.id
+        snapshot.append((item_id,
+                         item.shortdesc if item_id else item.description,
+                         item_owner.active_subprocess,
+                         worker.current_size, worker.total_size,
+                         item_owner.complete))
+    return snapshot
+
+
 class TextProgress(object):
     """Internal Base class for text progress classes."""
 
@@ -32,22 +69,39 @@ class TextProgress(object):
         # type: (Optional[io.TextIOBase]) -> None
         self._file = outfile or sys.stdout
         self._width = 0
+        try:
+            self._fd = self._file.fileno()
+            self._is_tty = os.isatty(self._fd)
+        except (AttributeError, OSError, ValueError):
+            self._fd = -1
+            self._is_tty = False
+        self._encoding = getattr(self._file, "encoding", None) or "utf-8"
+
+    def _raw_write(self, text):
+        # type: (str) -> None
+        """Write the text directly to the file descriptor of the terminal.
+
+        This bypasses the buffering (and locking) of the file object. Output
+        still buffered in it is flushed first to keep the order intact.
+        """
+        self._file.flush()
+        data = memoryview(text.encode(self._encoding, "replace"))
+        while data:
+            data = data[os.write(self._fd, data):]
 
     def _write(self, msg, newline=True, maximize=False):
         # type: (str, bool, bool) -> None
         """Write the message on the terminal, fill remaining space."""
-        self._file.write("\r")
-        self._file.write(msg)
-
+        width = self._width
+        if maximize and len(msg) > width:  # Needed for OpProgress.
+            self._width = width = len(msg)
         # Fill remaining stuff with whitespace
-        if self._width > len(msg):
-            self._file.write((self._width - len(msg)) * ' ')
-        elif maximize:  # Needed for OpProgress.
-            self._width = max(self._width, len(msg))
-        if newline:
-            self._file.write("\n")
-        else:
-            #self._file.write("\r")
+        text = "\r" + msg.ljust(width) + ("\n" if newline else "")
+        if self._is_tty:
+            self._raw_write(text)
+            return
+        self._file.write(text)
+        if not newline:
             self._file.flush()
 
 
@@ -69,7 +123,7 @@ class OpProgress(base.OpProgress, TextProgress):
         base.OpProgress.update(self, percent)
         if self.major_change and self.old_op:
             self._write(self.old_op)
-        self._write("%s... %i%%\r" % (self.op, self.percent), False, True)
+        self._write(f"{self.op}... {int(self.percent)}%\r", False, True)
         self.old_op = self.op
 
     def done(self):
@@ -91,6 +145,7 @@ class AcquireProgress(base.AcquireProgress, TextProgress):
         self._signal = None  # type: Union[Callable[[int, Optional[types.FrameType]], None], int, signal.Handlers, None] # noqa
         self._width = 80
         self._id = 1
+        self._last_draw = 0.0
 
     def start(self):
         # type: () -> None
@@ -105,15 +160,12 @@ class AcquireProgress(base.AcquireProgress, TextProgress):
         self._winch()
         self._id = 1
 
-    def _winch(self, *dummy):
-        # type: (object) -> None
+    def _winch(self, signum=None, frame=None):
+        # type: (Optional[int], Optional[types.FrameType]) -> None
         """Signal handler for window resize signals."""
-        if hasattr(self._file, "fileno") and os.isatty(self._file.fileno()):
-            import fcntl
-            import termios
-            import struct
-            buf = fcntl.ioctl(self._file, termios.TIOCGWINSZ, 8 * b' ')  # noqa
-            dummy, col, dummy, dummy = struct.unpack('hhhh', buf)
+        if self._is_tty:
+            buf = fcntl.ioctl(self._file, termios.TIOCGWINSZ, _WINSZ_BUF)
+            dummy, col, dummy, dummy = _WINSZ_UNPACK(buf)
             self._width = col - 1  # 1 for the cursor
 
     def ims_hit(self, item):
@@ -122,7 +174,7 @@ class AcquireProgress(base.AcquireProgress, TextProgress):
         base.AcquireProgress.ims_hit(self, item)
         line = _('Hit ') + item.description
         if item.owner.filesize:
-            line += ' [%sB]' % apt_pkg.size_to_str(item.owner.filesize)
+            line += f' [{apt_pkg.size_to_str(item.owner.filesize)}B]'
         self._write(line)
 
     def fail(self, item):
@@ -133,7 +185,7 @@ class AcquireProgress(base.AcquireProgress, TextProgress):
             self._write(_("Ign ") + item.description)
         else:
             self._write(_("Err ") + item.description)
-            self._write("  %s" % item.owner.error_text)
+            self._write(f"  {item.owner.error_text}")
 
     def fetch(self, item):
         # type: (apt_pkg.AcquireItemDesc) -> None
@@ -144,9 +196,9 @@ class AcquireProgress(base.AcquireProgress, TextProgress):
             return
         item.owner.id = self._id
         self._id += 1
-        line = _("Get:") + "%s %s" % (item.owner.id, item.description)
+        line = f"{_('Get:')}{item.owner.id} {item.description}"
         if item.owner.filesize:
-            line += (" [%sB]" % apt_pkg.size_to_str(item.owner.filesize))
+            line += f" [{apt_pkg.size_to_str(item.owner.filesize)}B]"
 
         self._write(line)
 
@@ -157,65 +209,75 @@ class AcquireProgress(base.AcquireProgress, TextProgress):
         Return False if the user asked to cancel the whole Acquire process."""
         base.AcquireProgress.pulse(self, owner)
         # only show progress on a tty to not clutter log files etc
-        if (hasattr(self._file, "fileno") and
-                not os.isatty(self._file.fileno())):
+        if not self._is_tty:
+            return True
+
+        # Do not redraw faster than the terminal can usefully display
+        now = time.monotonic()
+        if now - self._last_draw < 0.1 and self.current_cps:
             return True
 
+        size_to_str = apt_pkg.size_to_str
+        width = self._width
+
         # calculate progress
         percent = (((self.current_bytes + self.current_items) * 100.0) /
                         float(self.total_bytes + self.total_items))
 
-        shown = False
-        tval = '%i%%' % percent
+        tval = f'{int(percent)}%'
         end = ""
         if self.current_cps:
             eta = int(float(self.total_bytes - self.current_bytes) /
                         self.current_cps)
-            end = " %sB/s %s" % (apt_pkg.size_to_str(self.current_cps),
-                                 apt_pkg.time_to_str(eta))
-
-        for worker in owner.workers:
-            val = ''
-            if not worker.current_item:
-                if worker.status:
-                    val = ' [%s]' % worker.status
-                    if len(tval) + len(val) + len(end) >= self._width:
-                        break
-                    tval += val
-                    shown = True
+            end = (f" {size_to_str(self.current_cps)}B/s "
+                   f"{apt_pkg.time_to_str(eta)}")
+
+        # (text, whether the worker is fetching an item) for each worker
+        pieces = []
+        for (item_id, desc, subprocess, current_size, total_size,
+             complete) in _snapshot_workers(owner):
+            if item_id is None:
+                pieces.append((f' [{desc}]', False))
                 continue
-            shown = True
 
-            if worker.current_item.owner.id:
-                val += " [%i %s" % (worker.current_item.owner.id,
-                                    worker.current_item.shortdesc)
+            if item_id:
+                val_parts = [f" [{item_id} {desc}"]
             else:
-                val += ' [%s' % worker.current_item.description
-            if worker.current_item.owner.active_subprocess:
-                val += ' %s' % worker.current_item.owner.active_subprocess
+                val_parts = [f' [{desc}']
+            if subprocess:
+                val_parts.append(f' {subprocess}')
 
-            val += ' %sB' % apt_pkg.size_to_str(worker.current_size)
+            val_parts.append(f' {size_to_str(current_size)}B')
 
             # Add the total size and percent
-            if worker.total_size and not worker.current_item.owner.complete:
-                val += "/%sB %i%%" % (
-                    apt_pkg.size_to_str(worker.total_size),
-                    worker.current_size * 100.0 / worker.total_size)
+            if total_size and not complete:
+                val_parts.append(f"/{size_to_str(total_size)}B "
+                                 f"{int(current_size * 100.0 / total_size)}%")
 
-            val += ']'
+            val_parts.append(']')
+            pieces.append((''.join(val_parts), True))
 
-            if len(tval) + len(val) + len(end) >= self._width:
-                # Display as many items as screen width
-                break
-            else:
-                tval += val
+        # Display as many items as screen width
+        lengths = list(itertools.accumulate(len(val) for val, _item in pieces))
+        cutoff = bisect.bisect_left(lengths, width - len(tval) - len(end))
+        # A worker fetching an item counts as shown even if it did not fit
+        shown = cutoff > 0 or (cutoff < len(pieces) and pieces[cutoff][1])
+
+        parts = [tval]
+        parts.extend(val for val, _item in pieces[:cutoff])
+        cur_len = len(tval) + (lengths[cutoff - 1] if cutoff else 0)
 
         if not shown:
-            tval += _(" [Working]")
+            val = _(" [Working]")
+            parts.append(val)
+            cur_len += len(val)
 
         if self.current_cps:
-            tval += (self._width - len(end) - len(tval)) * ' ' + end
+            parts.append((width - len(end) - cur_len) * ' ')
+            parts.append(end)
 
+        tval = ''.join(parts)
+        self._last_draw = now
         self._write(tval, False)
         return True
 
@@ -239,7 +301,6 @@ class AcquireProgress(base.AcquireProgress, TextProgress):
                     apt_pkg.size_to_str(self.current_cps))).rstrip("\n"))
 
         # Delete the signal again.
-        import signal
         signal.signal(signal.SIGWINCH, self._signal)
 
 
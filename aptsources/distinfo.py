@@ -4,14 +4,69 @@ import csv
 import errno
 import logging
 import os
-from subprocess import Popen, PIPE
-import re
+from subprocess import SubprocessError, check_output
+import string
 
 import apt_pkg
 
 from apt_pkg import gettext as _
 
 
+# Mirror files contain location markers ("#LOC:...") and URLs using these
+# protocols and characters.
+_MIRROR_PROTOS = ("http", "https", "ftp", "rsync", "file", "mirror")
+_MIRROR_URL_CHARS = string.ascii_letters + string.digits + "/.:-_@"
+
+
+# Results of apt_pkg.string_to_bool() for the spellings used in templates
+_BOOLS = {"true": 1, "True": 1, "yes": 1, "false": 0, "False": 0, "no": 0}
+
+
+def _string_to_bool(value):
+    """Like apt_pkg.string_to_bool(), with a shortcut for common values."""
+    result = _BOOLS.get(value)
+    if result is None:
+        result = apt_pkg.string_to_bool(value)
+    return result
+
+
+def _section_fields(section):
+    """Return the (field, value) pairs of a TagFile section, in order.
+
+    Templates repeat fields such as Component within a section, so the
+    text of the section is split up instead of looking fields up by name:
+    apt_pkg.TagSection only gives access to the first value of a field.
+    This runs once per section of the template, _expand_template() and
+    DistInfo only pass the resulting pairs around.
+    """
+    fields = []
+    for line in str(section).splitlines():
+        (field, sep, value) = line.partition(':')
+        if sep:
+            fields.append((field.strip(), value.strip()))
+    return fields
+
+
+def _parse_x_version(x_version):
+    """Split an X-Version field into (operator, version) tuples.
+
+    The field is a list like "le 20.04, ge 10.10"; None gives an empty list.
+    """
+    if x_version is None:
+        return []
+    return [(field[:2], field[3:]) for field in x_version.split(", ")]
+
+
+def _version_allowed(constraints, version):
+    """Check whether 'version' satisfies the parsed X-Version constraints."""
+    # Version requirements. Maybe should be made nicer
+    for op, threshold in constraints:
+        result = apt_pkg.version_compare(threshold, version)
+        if (op == "le" and result < 0) or (op == "ge" and result > 0):
+            return False
+    return True
+
+
 def _expand_template(template, csv_path):
     """Expand the given template.
 
@@ -22,75 +77,79 @@ def _expand_template(template, csv_path):
     This function expands all templated suites using the information
     found in the CSV file supplied by distro-info-data.
 
-    It yields lines of template info.
+    It yields the (field, value) pairs of template info, with (None, None)
+    after each paragraph.
     """
 
-    known_suites = set()
+    excluded = set()  # X-Exclude-Suites of the header
+    hardcoded = set()  # suites that are not templated
+    head = []  # sections before the first templated suite
+    templated = []  # (fields, X-Version constraints) per templated suite
+    tail = []  # all other sections after the first templated suite
 
-    # Copy out any header, and gather all hardcoded suites
+    # Parse the template only once, sorting its sections into the above
+    # and gathering all hardcoded suites
     with apt_pkg.TagFile(template) as tmpl:
         for section in tmpl:
-            if "X-Exclude-Suites" in section:
-                known_suites.update(section["X-Exclude-Suites"].split(", "))
-            if "Suite" in section:
-                if "{" in section["Suite"]:
-                    break
+            suite = section.get("Suite")
+            if not templated and "X-Exclude-Suites" in section:
+                excluded.update(section["X-Exclude-Suites"].split(", "))
+            if suite is not None and "{" in suite:
+                templated.append(([(field, value) for (field, value)
+                                   in _section_fields(section)
+                                   if field != "X-Version"],
+                                  _parse_x_version(section.get("X-Version"))))
+                continue
+            if suite is not None:
+                hardcoded.add(suite)
+            (tail if templated else head).append(_section_fields(section))
 
-                known_suites.add(section["Suite"])
+    # Copy out any header
+    for fields in head:
+        yield from fields
+        yield (None, None)
 
-            yield from str(section).splitlines()
-        else:
-            # We did not break, so we did copy all of them
-            return
+    if not templated:
+        # There is nothing to expand, the header was everything
+        return
 
-        for section in tmpl:
-            if "Suite" in section:
-                known_suites.add(section["Suite"])
+    known_suites = frozenset(excluded | hardcoded)
 
+    # Only build the row dicts of the releases to be expanded, newest first
+    releases = []
     with open(csv_path) as csv_object:
-        releases = reversed(list(csv.DictReader(csv_object)))
+        rows = csv.reader(csv_object)
+        header = next(rows, None)  # None if the file is empty
+        if header is not None:
+            try:
+                series = header.index("series")
+            except ValueError:
+                raise KeyError("series") from None
+            releases = [dict(zip(header, row))
+                        for row in reversed(list(rows))
+                        if row and row[series] not in known_suites]
 
     # Perform template substitution on the middle of the list
     for rel in releases:
-        if rel["series"] in known_suites:
-            continue
-        yield ""
         rel["version"] = rel["version"].replace(" LTS", "")
-        with apt_pkg.TagFile(template) as tmpl:
-            for section in tmpl:
-                # Only work on template sections, this skips head and tails
-                if "Suite" not in section or "{" not in section["Suite"]:
-                    continue
-                if "X-Version" in section:
-                    # Version requirements. Maybe should be made nicer
-                    ver = rel["version"]
-                    if any(
-                            (field.startswith("le") and
-                             apt_pkg.version_compare(field[3:], ver) < 0) or
-                            (field.startswith("ge") and
-                             apt_pkg.version_compare(field[3:], ver) > 0)
-                            for field in section["X-Version"].split(", ")):
-                        continue
-
-                for line in str(section).format(**rel).splitlines():
-                    if line.startswith("X-Version"):
-                        continue
-                    yield line
+        ver = rel["version"]
+        for fields, constraints in templated:
+            if not _version_allowed(constraints, ver):
+                continue
+
+            for field, value in fields:
+                yield (field, value.format_map(rel))
+            yield (None, None)
 
     # Copy out remaining suites
-    with apt_pkg.TagFile(template) as tmpl:
-        # Skip the head again, we don't want to copy it twice
-        for section in tmpl:
-            if "Suite" in section and "{" in section["Suite"]:
-                break
+    for fields in tail:
+        yield from fields
+        yield (None, None)
 
-        for section in tmpl:
-            # Ignore any template parts and copy the rest out,
-            # this is the inverse of the template substitution loop
-            if "Suite" in section and "{" in section["Suite"]:
-                continue
 
-            yield from str(section).splitlines()
+def _translate(msg):
+    """Translate 'msg', passing None through."""
+    return None if msg is None else _(msg)
 
 
 class Template(object):
@@ -104,6 +163,7 @@ class Template(object):
         self.base_uri = None
         self.type = None
         self.components = []
+        self._component_names = set()  # names of self.components
         self.children = []
         self.match_uri = None
         self.mirror_set = {}
@@ -111,9 +171,19 @@ class Template(object):
         self.available = True
         self.official = True
 
+    # Descriptions are stored untranslated and translated when read, as
+    # most users only look at a few of the templates.
+    @property
+    def description(self):
+        return _translate(self._description)
+
+    @description.setter
+    def description(self, value):
+        self._description = value
+
     def has_component(self, comp):
         ''' Check if the distribution provides the given component '''
-        return comp in (c.name for c in self.components)
+        return comp in self._component_names
 
     def is_mirror(self, url):
         ''' Check if a given url of a repository is a valid mirror '''
@@ -132,6 +202,23 @@ class Component(object):
         self.description_long = long_desc
         self.parent_component = parent_component
 
+    # Descriptions are translated when read, see Template.description
+    @property
+    def description(self):
+        return _translate(self._description)
+
+    @description.setter
+    def description(self, value):
+        self._description = value
+
+    @property
+    def description_long(self):
+        return _translate(self._description_long)
+
+    @description_long.setter
+    def description_long(self, value):
+        self._description_long = value
+
     def get_parent_component(self):
         return self.parent_component
 
@@ -162,20 +249,23 @@ class Mirror(object):
     def __init__(self, proto, hostname, dir, location=None):
         self.hostname = hostname
         self.repositories = []
+        self._by_proto = {}  # proto -> list of Repository
         self.add_repository(proto, dir)
         self.location = location
 
     def add_repository(self, proto, dir):
-        self.repositories.append(Repository(proto, dir))
+        repo = Repository(proto, dir)
+        self.repositories.append(repo)
+        self._by_proto.setdefault(proto, []).append(repo)
 
     def get_repositories_for_proto(self, proto):
-        return [r for r in self.repositories if r.proto == proto]
+        return list(self._by_proto.get(proto, ()))
 
     def has_repository(self, proto, dir):
         if dir is None:
             return False
-        for r in self.repositories:
-            if r.proto == proto and dir in r.dir:
+        for r in self._by_proto.get(proto, ()):
+            if dir in r.dir:
                 return True
         return False
 
@@ -199,12 +289,21 @@ class Repository(object):
         return self.proto, self.dir
 
     def get_url(self, hostname):
-        return "%s://%s/%s" % (self.proto, hostname, self.dir)
+        return f"{self.proto}://{hostname}/{self.dir}"
 
 
 def split_url(url):
     ''' split a given URL into the protocoll, the hostname and the dir part '''
-    split = re.split(":*\\/+", url, maxsplit=2)
+    # Same result as re.split(":*/+", url, maxsplit=2), without the regex
+    split = []
+    rest = url
+    while len(split) < 2:
+        slash = rest.find("/")
+        if slash < 0:
+            break
+        split.append(rest[:slash].rstrip(":"))
+        rest = rest[slash:].lstrip("/")
+    split.append(rest)
     while len(split) < 3:
         split.append(None)
     return split
@@ -215,141 +314,200 @@ class DistInfo(object):
     def __init__(self, dist=None, base_dir="/usr/share/python-apt/templates"):
         self.metarelease_uri = ''
         self.templates = []
+        # name -> templates of that name, in the order of self.templates
+        self._templates_by_name = {}
         self.arch = apt_pkg.config.find("APT::Architecture")
 
-        location = None
-        match_loc = re.compile(r"^#LOC:(.+)$")
-        match_mirror_line = re.compile(
-            r"^(#LOC:.+)|(((http)|(ftp)|(rsync)|(file)|(mirror)|(https))://"
-            r"[A-Za-z0-9/\.:\-_@]+)$")
-        #match_mirror_line = re.compile(r".+")
-
         if not dist:
+            # Not read from /etc/os-release, whose lowercase ID does not
+            # match the template names, see distro.get_distro().
             try:
-                dist = Popen(["lsb_release", "-i", "-s"],
-                             universal_newlines=True,
-                             stdout=PIPE).communicate()[0].strip()
-            except (OSError, IOError) as exc:
-                if exc.errno != errno.ENOENT:
+                dist = check_output(["lsb_release", "-i", "-s"],
+                                    universal_newlines=True,
+                                    timeout=10).strip()
+            except (OSError, SubprocessError) as exc:
+                if getattr(exc, "errno", None) != errno.ENOENT:
                     logging.warning(
-                        'lsb_release failed, using defaults:' % exc)
+                        'lsb_release failed, using defaults: %s' % exc)
                 dist = "Debian"
 
         self.dist = dist
 
-        map_mirror_sets = {}
-
         dist_fname = "%s/%s.info" % (base_dir, dist)
         csv_fname = "/usr/share/distro-info/{}.csv".format(dist.lower())
 
-        template = None
-        component = None
-        for line in _expand_template(dist_fname, csv_fname):
-            tokens = line.split(':', 1)
-            if len(tokens) < 2:
-                continue
-            field = tokens[0].strip()
-            value = tokens[1].strip()
-            if field == 'ChangelogURI':
-                self.changelogs_uri = _(value)
-            elif field == 'MetaReleaseURI':
-                self.metarelease_uri = value
-            elif field == 'Suite':
-                self.finish_template(template, component)
-                component = None
-                template = Template()
-                template.name = value
-                template.distribution = dist
-                template.match_name = "^%s$" % value
-            elif field == 'MatchName':
-                template.match_name = value
-            elif field == 'ParentSuite':
-                template.child = True
-                for nanny in self.templates:
-                    # look for parent and add back ref to it
-                    if nanny.name == value:
-                        template.parents.append(nanny)
-                        nanny.children.append(template)
-            elif field == 'Available':
-                template.available = apt_pkg.string_to_bool(value)
-            elif field == 'Official':
-                template.official = apt_pkg.string_to_bool(value)
-            elif field == 'RepositoryType':
-                template.type = value
-            elif field == 'BaseURI' and not template.base_uri:
-                template.base_uri = value
-            elif field == 'BaseURI-%s' % self.arch:
-                template.base_uri = value
-            elif field == 'MatchURI' and not template.match_uri:
-                template.match_uri = value
-            elif field == 'MatchURI-%s' % self.arch:
-                template.match_uri = value
-            elif (field == 'MirrorsFile' or
-                  field == 'MirrorsFile-%s' % self.arch):
-                # Make the path absolute.
-                value = os.path.isabs(value) and value or \
-                        os.path.abspath(os.path.join(base_dir, value))
-                if value not in map_mirror_sets:
-                    mirror_set = {}
-                    try:
-                        with open(value) as value_f:
-                            mirror_data = list(filter(
-                                match_mirror_line.match,
-                                [x.strip() for x in value_f]))
-                    except Exception:
-                        print("WARNING: Failed to read mirror file")
-                        mirror_data = []
-                    for line in mirror_data:
-                        if line.startswith("#LOC:"):
-                            location = match_loc.sub(r"\1", line)
-                            continue
-                        (proto, hostname, dir) = split_url(line)
-                        if hostname in mirror_set:
-                            mirror_set[hostname].add_repository(proto, dir)
-                        else:
-                            mirror_set[hostname] = Mirror(
-                                proto, hostname, dir, location)
-                    map_mirror_sets[value] = mirror_set
-                template.mirror_set = map_mirror_sets[value]
-            elif field == 'Description':
-                template.description = _(value)
-            elif field == 'Component':
-                if (component and not
-                        template.has_component(component.name)):
-                    template.components.append(component)
-                component = Component(value)
-            elif field == 'CompDescription':
-                component.set_description(_(value))
-            elif field == 'CompDescriptionLong':
-                component.set_description_long(_(value))
-            elif field == 'ParentComponent':
-                component.set_parent_component(value)
-        self.finish_template(template, component)
-        template = None
-        component = None
+        # State while parsing the template
+        # Absolute, so that relative mirror file names only need a join
+        self._base_dir = os.path.abspath(base_dir)
+        self._location = None
+        self._map_mirror_sets = {}
+        self._template = None
+        self._component = None
+
+        handlers = {
+            'ChangelogURI': self._set_changelogs_uri,
+            'MetaReleaseURI': self._set_metarelease_uri,
+            'Suite': self._begin_template,
+            'MatchName': self._set_match_name,
+            'ParentSuite': self._set_parent_suite,
+            'Available': self._set_available,
+            'Official': self._set_official,
+            'RepositoryType': self._set_repository_type,
+            'BaseURI': self._set_base_uri,
+            'BaseURI-%s' % self.arch: self._set_arch_base_uri,
+            'MatchURI': self._set_match_uri,
+            'MatchURI-%s' % self.arch: self._set_arch_match_uri,
+            'MirrorsFile': self._set_mirrors_file,
+            'MirrorsFile-%s' % self.arch: self._set_mirrors_file,
+            'Description': self._set_description,
+            'Component': self._begin_component,
+            'CompDescription': self._set_comp_description,
+            'CompDescriptionLong': self._set_comp_description_long,
+            'ParentComponent': self._set_parent_component,
+        }
+        for field, value in _expand_template(dist_fname, csv_fname):
+            handler = handlers.get(field)
+            if handler is not None:
+                handler(value)
+        self.finish_template(self._template, self._component)
+        self._template = None
+        self._component = None
+
+    # The URI is translated when read, see Template.description
+    @property
+    def changelogs_uri(self):
+        return _(self._changelogs_uri)
+
+    @changelogs_uri.setter
+    def changelogs_uri(self, value):
+        self._changelogs_uri = value
+
+    # Handlers for the fields of the template, see __init__()
+
+    def _set_changelogs_uri(self, value):
+        self.changelogs_uri = value
+
+    def _set_metarelease_uri(self, value):
+        self.metarelease_uri = value
+
+    def _begin_template(self, value):
+        self.finish_template(self._template, self._component)
+        self._component = None
+        template = self._template = Template()
+        template.name = value
+        template.distribution = self.dist
+        template.match_name = "^%s$" % value
+
+    def _set_match_name(self, value):
+        self._template.match_name = value
+
+    def _set_parent_suite(self, value):
+        template = self._template
+        template.child = True
+        for nanny in self._templates_by_name.get(value, ()):
+            # add back ref to the parent
+            template.parents.append(nanny)
+            nanny.children.append(template)
+
+    def _set_available(self, value):
+        self._template.available = _string_to_bool(value)
+
+    def _set_official(self, value):
+        self._template.official = _string_to_bool(value)
+
+    def _set_repository_type(self, value):
+        self._template.type = value
+
+    def _set_base_uri(self, value):
+        if not self._template.base_uri:
+            self._template.base_uri = value
+
+    def _set_arch_base_uri(self, value):
+        self._template.base_uri = value
+
+    def _set_match_uri(self, value):
+        if not self._template.match_uri:
+            self._template.match_uri = value
+
+    def _set_arch_match_uri(self, value):
+        self._template.match_uri = value
+
+    def _set_mirrors_file(self, value):
+        # Make the path absolute.
+        if not os.path.isabs(value):
+            value = os.path.join(self._base_dir, value)
+        if value not in self._map_mirror_sets:
+            mirror_set = {}
+            try:
+                # Decode the whole file at once, the mirror lists
+                # are plain ASCII
+                with open(value, "rb") as value_f:
+                    lines = value_f.read().decode("utf-8").splitlines()
+            except Exception:
+                print("WARNING: Failed to read mirror file")
+                lines = []
+            for line in lines:
+                line = line.strip()
+                if line.startswith("#LOC:"):
+                    if len(line) > 5:
+                        self._location = line[5:]
+                    continue
+                # Only use URLs made up of the allowed characters
+                (proto, sep, rest) = line.partition("://")
+                if (not sep or proto not in _MIRROR_PROTOS or not rest or
+                        rest.strip(_MIRROR_URL_CHARS)):
+                    continue
+                (proto, hostname, dir) = split_url(line)
+                if hostname in mirror_set:
+                    mirror_set[hostname].add_repository(proto, dir)
+                else:
+                    mirror_set[hostname] = Mirror(
+                        proto, hostname, dir, self._location)
+            self._map_mirror_sets[value] = mirror_set
+        self._template.mirror_set = self._map_mirror_sets[value]
+
+    def _set_description(self, value):
+        self._template.description = value
+
+    def _begin_component(self, value):
+        template = self._template
+        component = self._component
+        if component and not template.has_component(component.name):
+            template.components.append(component)
+            template._component_names.add(component.name)
+        self._component = Component(value)
+
+    def _set_comp_description(self, value):
+        self._component.set_description(value)
+
+    def _set_comp_description_long(self, value):
+        self._component.set_description_long(value)
+
+    def _set_parent_component(self, value):
+        self._component.set_parent_component(value)
 
     def finish_template(self, template, component):
         " finish the current tempalte "
         if not template:
             return
-        # reuse some properties of the parent template
-        if template.match_uri is None and template.child:
-            for t in template.parents:
-                if t.match_uri:
+        # reuse some properties of the first parent with a match_uri,
+        # the official attribute is inherited from the last parent
+        inherit_uri = template.match_uri is None
+        inherit_mirrors = template.mirror_set == {}
+        for t in template.parents:
+            if t.match_uri and (inherit_uri or inherit_mirrors):
+                if inherit_uri:
                     template.match_uri = t.match_uri
-                    break
-        if template.mirror_set == {} and template.child:
-            for t in template.parents:
-                if t.match_uri:
+                if inherit_mirrors:
                     template.mirror_set = t.mirror_set
-                    break
+                inherit_uri = inherit_mirrors = False
+            template.official = t.official
         if component and not template.has_component(component.name):
             template.components.append(component)
+            template._component_names.add(component.name)
             component = None
-        # the official attribute is inherited
-        for t in template.parents:
-            template.official = t.official
         self.templates.append(template)
+        self._templates_by_name.setdefault(template.name, []).append(template)
 
 
 if __name__ == "__main__":
@@ -7,5 +7,9 @@ import sys
 
 import aptsources.distinfo
 
-for line in aptsources.distinfo._expand_template(sys.argv[1], sys.argv[2]):
-    print(line)
+for field, value in aptsources.distinfo._expand_template(sys.argv[1],
+                                                         sys.argv[2]):
+    if field is None:
+        print()
+    else:
+        print("%s: %s" % (field, value))